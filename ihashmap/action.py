@@ -1,10 +1,13 @@
-class Action:
+import collections
+
+
+class Action(collections.namedtuple("Action", ("f", "priority", "cache_name"))):
     """PipelineManager action representation."""
 
-    def __init__(self, f, priority, cache_name=None):
-        self.f = f
-        self.priority = priority
-        self.cache_name = cache_name
+    __slots__ = ()
 
     def __call__(self, *args, **kwargs):
         return self.f(*args, **kwargs)
+
+
+Action.__new__.__defaults__ = (None,)
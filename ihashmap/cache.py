@@ -1,13 +1,112 @@
+import bisect
 import collections
 import copy
 import functools
-import types
+import heapq
+import itertools
+import operator
+import threading
 import typing
+import weakref
 
 from ihashmap.action import Action
 
+_index_module = None
+
+
+def _get_index_module():
+    """Imports ihashmap.index once on first use as it depends on this module."""
+
+    global _index_module
+    if _index_module is None:
+        from ihashmap import index
+
+        _index_module = index
+    return _index_module
+
+
+def get_shadow_copy(value):
+    """Returns value .__shadow_copy__ or value itself if it has none."""
+
+    return getattr(value, "__shadow_copy__", value)
+
+
+def _shallow_copy(value):
+    """Copies value skipping copy protocol for plain UserDict/UserList."""
+
+    if type(value) in (collections.UserDict, collections.UserList):
+        new_value = value.__class__.__new__(value.__class__)
+        new_value.__dict__.update(value.__dict__)
+        new_value.data = value.data.copy()
+        return new_value
+    return copy.copy(value)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_runner(before: tuple, after: tuple) -> typing.Callable:
+    """Generates function executing actions around main function without loops.
+
+    Runner is shared by all pipes and cache names with same actions.
+
+    :param before: functions executed before main function.
+    :param after: functions executed after main function.
+    :return: function(ctx) returning ctx.result.
+    """
+
+    namespace = {}
+    lines = ["def run(ctx):"]
+    for stage, functions in (("before", before), ("after", after)):
+        if stage == "after":
+            lines.append(
+                "    ctx.result = ctx.f(ctx.cls_or_self, ctx.name, *ctx.args, **ctx.kwargs)"
+            )
+        for number, f in enumerate(functions):
+            namespace[f"{stage}_{number}"] = f
+            lines.append(f"    {stage}_{number}(ctx)")
+    lines.append("    return ctx.result")
+    exec("\n".join(lines), namespace)
+    return namespace["run"]
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_filter(equal_count: int, callable_count: int) -> typing.Callable:
+    """Generates function filtering values by query of specific shape.
+
+    Every value is checked by single expression which stops on first failing term.
+
+    :param int equal_count: number of equality terms.
+    :param int callable_count: number of callable terms.
+    :return: function(values, pairs) returning list of matching values,
+             where pairs are equality pairs followed by callable pairs.
+    """
+
+    numbers = range(equal_count + callable_count)
+    terms = [f"value.get(key_{number}) == term_{number}" for number in numbers]
+    for number in numbers[equal_count:]:
+        terms[number] = f"term_{number}(value.get(key_{number}))"
+    lines = ["def filter_values(values, pairs):"]
+    if terms:
+        pairs = "".join(f"(key_{number}, term_{number}), " for number in numbers)
+        lines.append(f"    {pairs}= pairs")
+    condition = " and ".join(terms) or "True"
+    lines.append(f"    return [value for value in values if {condition}]")
+    namespace = {}
+    exec("\n".join(lines), namespace)
+    return namespace["filter_values"]
+
+
+_contexts = threading.local()
+
 
 class PipelineContext:
+    """Single pipeline execution state.
+
+    Contexts are reused within thread,
+    so actions must not keep them after pipeline execution.
+    """
+
+    __slots__ = ("f", "cls_or_self", "name", "args", "kwargs", "result", "local_data")
+
     def __init__(self, f, cls_or_self, name, *args, **kwargs):
         self.f = f
         self.cls_or_self = cls_or_self
@@ -27,64 +126,180 @@ class Pipeline:
     temporary data between actions.
     """
 
+    __slots__ = (
+        "name",
+        "parent_pipe",
+        "_pipe_before",
+        "_pipe_after",
+        "_seq",
+        "_sorted_before",
+        "_sorted_after",
+        "_applicable_cache",
+        "_resolved",
+        "_children",
+        "__weakref__",
+    )
+
+    APPLICABLE_CACHE_SIZE = 1024
+    """Max number of cache names with memoized actions per pipe."""
+
     def __init__(self, name, parent_pipe=None):
         self.name = name
         self.parent_pipe = parent_pipe
         self._pipe_before = []
         self._pipe_after = []
+        self._seq = itertools.count()
+        self._sorted_before = None
+        self._sorted_after = None
+        self._applicable_cache = {}
+        self._resolved = weakref.WeakKeyDictionary()
+        self._children = weakref.WeakSet()
+        if parent_pipe is not None:
+            parent_pipe._children.add(self)
 
     @property
     def pipe_before(self):
-        pipe = []
-        if self.parent_pipe is not None:
-            pipe += self.parent_pipe.pipe_before
-        pipe += self._pipe_before
-        pipe.sort(key=lambda action: action.priority)
-        return pipe
+        if self._sorted_before is None:
+            parent = () if self.parent_pipe is None else self.parent_pipe.pipe_before
+            self._sorted_before = self._merge(parent, self._pipe_before)
+        return self._sorted_before
 
     @property
     def pipe_after(self):
-        pipe = []
-        if self.parent_pipe is not None:
-            pipe += self.parent_pipe.pipe_after
-        pipe += self._pipe_after
-        pipe.sort(key=lambda action: action.priority)
-        return pipe
+        if self._sorted_after is None:
+            parent = () if self.parent_pipe is None else self.parent_pipe.pipe_after
+            self._sorted_after = self._merge(parent, self._pipe_after)
+        return self._sorted_after
+
+    @staticmethod
+    def _merge(parent_actions, pipe):
+        """Merges sorted parent actions with sorted pipe entries by priority.
+
+        Parent actions go first among actions with equal priority.
+        """
+
+        return tuple(
+            heapq.merge(
+                parent_actions,
+                (action for _, _, action in pipe),
+                key=operator.attrgetter("priority"),
+            )
+        )
+
+    def invalidate(self):
+        """Drops cached action lists of this pipe and all child pipes.
+
+        Child pipes build their lists from this pipe ones,
+        so if nothing is cached here there is nothing to drop below either.
+        """
+
+        if self._sorted_before is None and self._sorted_after is None:
+            return
+        self._sorted_before = None
+        self._sorted_after = None
+        self._applicable_cache.clear()
+        for child in self._children:
+            child.invalidate()
 
     def before(self, priority=1, cache_name=None):
         def wrapper(f):
-            self._pipe_before.append(Action(f, priority, cache_name=cache_name))
+            action = Action(f, priority, cache_name=cache_name)
+            bisect.insort(self._pipe_before, (priority, next(self._seq), action))
+            self.invalidate()
             return f
 
         return wrapper
 
     def after(self, priority=1, cache_name=None):
         def wrapper(f):
-            self._pipe_after.append(Action(f, priority, cache_name=cache_name))
+            action = Action(f, priority, cache_name=cache_name)
+            bisect.insort(self._pipe_after, (priority, next(self._seq), action))
+            self.invalidate()
             return f
 
         return wrapper
 
+    def actions_for(self, cache_name):
+        """Returns before and after action functions applicable for cache name.
+
+        :param str cache_name: cache name.
+        :return: tuple of (before functions, after functions).
+        """
+
+        return self._applicable(cache_name)[:2]
+
+    def runner_for(self, cache_name):
+        """Returns generated function running pipe for cache name.
+
+        :param str cache_name: cache name.
+        :return: function(ctx) returning ctx.result or None if pipe is empty.
+        """
+
+        return self._applicable(cache_name)[2]
+
+    def _applicable(self, cache_name):
+        """Memoizes before functions, after functions and runner for cache name.
+
+        Memo is dropped once it holds APPLICABLE_CACHE_SIZE names,
+        so dynamically built cache names don't grow it forever.
+        """
+
+        applicable = self._applicable_cache.get(cache_name)
+        if applicable is None:
+            if len(self._applicable_cache) >= self.APPLICABLE_CACHE_SIZE:
+                self._applicable_cache.clear()
+            before, after = (
+                tuple(
+                    f
+                    for f, _, action_cache_name in pipe
+                    if action_cache_name is None or action_cache_name == cache_name
+                )
+                for pipe in (self.pipe_before, self.pipe_after)
+            )
+            runner = _compile_runner(before, after) if before or after else None
+            applicable = (before, after, runner)
+            self._applicable_cache[cache_name] = applicable
+        return applicable
+
     def wrap_before(self, ctx: PipelineContext):
         """Executes all actions in parents _pipe_before and this pipes."""
 
-        for action in self.pipe_before:
-            if action.cache_name in [None, ctx.name]:
-                action(ctx)
+        for f in self.actions_for(ctx.name)[0]:
+            f(ctx)
 
     def wrap_after(self, ctx: PipelineContext):
         """Executes all actions in parents _pipe_after and this pipes."""
 
-        for action in self.pipe_after:
-            if action.cache_name in [None, ctx.name]:
-                action(ctx)
+        for f in self.actions_for(ctx.name)[1]:
+            f(ctx)
 
     def wrap_action(self, ctx: PipelineContext):
-        self.wrap_before(ctx)
+        before, after = self.actions_for(ctx.name)
+        for f in before:
+            f(ctx)
         ctx.result = ctx.f(ctx.cls_or_self, ctx.name, *ctx.args, **ctx.kwargs)
-        self.wrap_after(ctx)
+        for f in after:
+            f(ctx)
         return ctx.result
 
+    def resolve(self, cls_or_self) -> "Pipeline":
+        """Finds pipe with this pipe name for caller class.
+
+        Result is remembered per caller class for callers other than Cache,
+        as Cache callers keep their pipes in their own PIPELINE.
+
+        :param cls_or_self: class or instance main function is called with.
+        :return: pipe to execute.
+        """
+
+        pipeline = self
+        if isinstance(cls_or_self, Cache):
+            return getattr(cls_or_self.PIPELINE, self.name)
+        elif isinstance(cls_or_self, _get_index_module().Index):
+            pipeline = getattr(Cache.PIPELINE, self.name)
+        self._resolved[type(cls_or_self)] = pipeline
+        return pipeline
+
     def __call__(self, f: typing.Callable) -> typing.Callable:
         """Wrapper around main function.
         Executes actions before and after main function execution.
@@ -93,17 +308,44 @@ class Pipeline:
         :return: wrapped function.
         """
 
+        pipe_name = self.name
+        get_resolved = self._resolved.get
+        resolve = self.resolve
+
         @functools.wraps(f)
         def wrap(cls_or_self, name, *args, **kwargs):
-            from ihashmap.index import Index
-
-            pipeline = self
             if isinstance(cls_or_self, Cache):
-                pipeline = getattr(cls_or_self.PIPELINE, self.name)
-            elif isinstance(cls_or_self, Index):
-                pipeline = getattr(Cache.PIPELINE, self.name)
-            ctx = PipelineContext(f, cls_or_self, name, *args, **kwargs)
-            return pipeline.wrap_action(ctx)
+                pipeline = cls_or_self.PIPELINE.pipes.get(pipe_name)
+            else:
+                pipeline = get_resolved(type(cls_or_self))
+            if pipeline is None:
+                pipeline = resolve(cls_or_self)
+            applicable = pipeline._applicable_cache.get(name)
+            if applicable is None:
+                runner = pipeline.runner_for(name)
+            else:
+                runner = applicable[2]
+            if runner is None:
+                return f(cls_or_self, name, *args, **kwargs)
+            try:
+                pool = _contexts.pool
+            except AttributeError:
+                pool = _contexts.pool = []
+            if pool:
+                ctx = pool.pop()
+                ctx.f = f
+                ctx.cls_or_self = cls_or_self
+                ctx.name = name
+                ctx.args = args
+                ctx.kwargs = kwargs
+            else:
+                ctx = PipelineContext(f, cls_or_self, name, *args, **kwargs)
+            result = runner(ctx)
+            ctx.cls_or_self = ctx.args = ctx.kwargs = ctx.result = None
+            if ctx.local_data:
+                ctx.local_data.clear()
+            pool.append(ctx)
+            return result
 
         return wrap
 
@@ -111,6 +353,8 @@ class Pipeline:
 class PipelineManager:
     """Manager."""
 
+    __slots__ = ("pipes",)
+
     def __init__(self, parent_manager=None):
         self.pipes = {}
         if parent_manager is not None:
@@ -142,12 +386,25 @@ class Cache:
     PRIMARY_KEY = "_id"
     """Values primary key existing in all values."""
 
+    SHADOW_COPY = True
+    """Attach .__shadow_copy__ to values on get/set/update.
+
+    Disable if values are never changed in place,
+    then indexes read stored value before update instead.
+    """
+
     GET_METHOD = lambda cache, name, key, default=None: None  # noqa: E731
     SET_METHOD = lambda cache, name, key, value: None  # noqa: E731
     UPDATE_METHOD = lambda cache, name, key, value: None  # noqa: E731
     DELETE_METHOD = lambda cache, name, key: None  # noqa: E731
     """METHODS placeholders. You should register yours."""
 
+    GET_MANY_METHOD = None
+    """Optional batch get method with signature (cache, name, keys).
+
+    Must return list of values in keys order with None for missing keys.
+    """
+
     @PIPELINE.set
     def set(self, name: str, key: str, value: typing.Mapping):
         """Wrapper for pipeline execution.
@@ -173,6 +430,18 @@ class Cache:
 
         return self.GET_METHOD(name, key, default)
 
+    def get_many(self, name: str, keys: typing.Iterable[str]) -> typing.List:
+        """Gets values for several keys.
+
+        Uses GET_MANY_METHOD in one call if registered, otherwise .get per key.
+
+        :param str name: cache name.
+        :param keys: hash keys.
+        :return: list of values in keys order, None for missing keys.
+        """
+
+        return self._fetch(name, keys)
+
     @PIPELINE.update
     def update(self, name: str, key: str, value: typing.Mapping):
         """Wrapper for pipeline execution.
@@ -201,13 +470,22 @@ class Cache:
         :return:
         """
 
-        from ihashmap.index import PkIndex
+        return list(self.iter_all(name))
+
+    def iter_all(self, name: str, batch_size: int = 128) -> typing.Iterator:
+        """Iterates over all values in cache fetching them in batches.
 
-        index_data = PkIndex.get(name)
-        result = []
-        for item_key in index_data:
-            result.append(self._get(name, item_key))
-        return result
+        :param str name: cache name.
+        :param int batch_size: number of values fetched at once.
+        :return: iterator over values.
+        """
+
+        keys = list(_get_index_module().PkIndex.get(name))
+        for start in range(0, len(keys), batch_size):
+            end = start + batch_size
+            for value in self._fetch(name, keys[start:end]):
+                if value is not None:
+                    yield value
 
     @classmethod
     def register_get_method(cls, method: typing.Callable):
@@ -246,28 +524,44 @@ class Cache:
         cls.DELETE_METHOD = method
 
     @classmethod
-    def _match_query(cls, value: dict, query: dict, is_index=False):
-        """Matches query to mapping values.
+    def register_get_many_method(cls, method: typing.Callable):
+        """Registers batch get method for global cache usage.
 
-        :param value: value to match against pattern
-        :param query: dict se
-        :return:
+        :param method: function which will be called to fetch several keys at once.
         """
 
-        matched = []
-        match = {key: False for key in query}
+        cls.GET_MANY_METHOD = method
+
+    @classmethod
+    def _split_query(cls, query: dict) -> typing.Tuple[tuple, tuple]:
+        """Splits query into equality and callable terms.
+
+        :param query: search key:value to match.
+        :return: tuple of (equality pairs, callable pairs).
+        """
+
+        equal_pairs, callable_pairs = [], []
         for search_key, search_value in query.items():
-            if isinstance(search_value, types.FunctionType):
-                if search_value(value.get(search_key)):
-                    match[search_key] = True
+            if callable(search_value):
+                callable_pairs.append((search_key, search_value))
             else:
-                if is_index:
-                    search_value = str(search_value)
-                if value.get(search_key) == search_value:
-                    match[search_key] = True
-        if all(match.values()):
-            matched.append(value)
-        return matched
+                equal_pairs.append((search_key, search_value))
+        return tuple(equal_pairs), tuple(callable_pairs)
+
+    @classmethod
+    def _filter_batch(cls, values: typing.List, query: dict) -> typing.List:
+        """Filters batch of values with function generated for query shape.
+
+        Equality checks go first as they are cheaper than functions.
+
+        :param values: values to filter.
+        :param query: search key:value to match.
+        :return: list of matching values in original order.
+        """
+
+        equal_pairs, callable_pairs = cls._split_query(query)
+        filter_values = _compile_filter(len(equal_pairs), len(callable_pairs))
+        return filter_values(values, equal_pairs + callable_pairs)
 
     def search(
         self,
@@ -275,44 +569,67 @@ class Cache:
         search_query: typing.Mapping[
             str, typing.Union[str, int, tuple, list, typing.Callable]
         ],
+        project_only: bool = False,
     ) -> typing.List[typing.Mapping]:
         """Searches cache for required values based on search query.
 
         :param name: cache name.
         :param dict search_query: search key:value to match.
                                   Values can be any builtin type
-                                  or function to which value will be passed as argument.
+                                  or callable to which value will be passed as argument.
+        :param bool project_only: if best index covers whole query return
+                                  matching index rows (dicts of index keys
+                                  with str values) without fetching values.
         :return: list of matching values.
         """
 
-        from ihashmap.index import Index
+        index = _get_index_module()
+        best_index = index.Index.find_best_index(name, frozenset(search_query))
+        index_keys = best_index.keys
+        subquery, rest_query = {}, {}
+        for key, value in search_query.items():
+            if key not in index_keys:
+                rest_query[key] = value
+            elif callable(value):
+                subquery[key] = value
+            else:
+                subquery[key] = str(value)
+        if not index.BloomFilter.might_contain(name, subquery):
+            return []
+        matched = best_index.find_rows(name, subquery)
+        if not matched or (project_only and not rest_query):
+            return matched
+        primary_key = self.PRIMARY_KEY
+        entities = self._fetch(name, [value[primary_key] for value in matched])
+        entities = [entity for entity in entities if entity is not None]
+        if not rest_query:
+            return entities
+        return self._filter_batch(entities, rest_query)
+
+    def _fetch(self, name: str, keys: typing.Iterable[str]) -> typing.List:
+        """Gets values for several keys in one batch if GET_MANY_METHOD is registered.
+
+        Batch values are passed through get pipe one by one,
+        so its actions run as for .get, except that before actions
+        run after values are already fetched.
 
-        index_match = []
-        indexes = Index.find_index_for_cache(name)
-        for index in indexes:
-            index_match.append(
-                len(set(index.keys).intersection(search_query)) / len(search_query)
-            )
-        best_choice_index = index_match.index(max(index_match))
-        best_index = indexes[best_choice_index]
-        index_data = set(best_index.get(name))
-        index_data = best_index.get_values(index_data)
-        matched = []
-        subquery = {
-            key: value for key, value in search_query.items() if key in best_index.keys
-        }
-        rest_query = {
-            key: value
-            for key, value in search_query.items()
-            if key not in best_index.keys
-        }
-        for value in index_data:
-            matched += self._match_query(value, subquery, is_index=True)
-        result = []
-        for value in matched:
-            entity = self._get(name, value[self.PRIMARY_KEY])
-            result += self._match_query(entity, rest_query)
-        return result
+        :param str name: cache name.
+        :param keys: hash keys.
+        :return: list of values in keys order, None for missing keys.
+        """
+
+        if self.GET_MANY_METHOD is None:
+            get = self._get
+            return [get(name, key) for key in keys]
+        keys = list(keys)
+        values = self._get_many(name, keys)
+        runner = self.PIPELINE.get.runner_for(name)
+        if runner is None:
+            return values
+        return [
+            runner(PipelineContext(lambda *args: value, self, name, key))
+            for key, value in zip(keys, values)
+        ]
 
     @PIPELINE.get
     def _get(self, name: str, key: str, default: typing.Optional[typing.Any] = None):
@@ -320,6 +637,12 @@ class Cache:
 
         return self.GET_METHOD(name, key, default)
 
+    @PIPELINE.get_many
+    def _get_many(self, name, keys):
+        """Internal method. PLEASE DONT CHANGE!"""
+
+        return self.GET_MANY_METHOD(name, keys)
+
     @PIPELINE.set
     def _set(self, name, key, value):
         """Internal method. PLEASE DONT CHANGE!"""
@@ -348,12 +671,11 @@ class Cache:
 def add_shadow_copy(ctx: PipelineContext):
     """Add .__shadow_copy__ attribute for future use in pipelines."""
 
+    if not getattr(ctx.cls_or_self, "SHADOW_COPY", True):
+        return
     if ctx.result is not None:
         ctx.result.__shadow_copy__ = ctx.result
     elif "original_value" in ctx.local_data:
         value = ctx.local_data["original_value"]
-        try:
-            delattr(value, "__shadow_copy__")
-        except AttributeError:
-            pass
-        value.__shadow_copy__ = copy.copy(value)
+        getattr(value, "__dict__", {}).pop("__shadow_copy__", None)
+        value.__shadow_copy__ = _shallow_copy(value)
@@ -1,8 +1,12 @@
 import bisect
 import collections
+import functools
+import hashlib
+import itertools
+import operator
 import typing
 
-from ihashmap.cache import Cache, PipelineContext
+from ihashmap.cache import Cache, PipelineContext, get_shadow_copy
 
 
 class IndexContainer(collections.UserList):
@@ -19,10 +23,21 @@ class Index:
     INDEX_CACHE_NAME: str = "indexes"
     cache_name: str = None
     keys: typing.List[str]
+    bloom_filter: bool = False
+    """Track keys values in BloomFilter for quick negative search answers.
+
+    Enable in class body before storing any values, otherwise search may miss them.
+    Changing it after index class creation has no effect.
+    """
 
     __INDEXES__ = {}
     """Storage for all existing indexes."""
 
+    __KEY_BITS__ = {}
+    """Bit assigned to every index key for quick keys intersection."""
+
+    key_mask: int = 0
+
     HOOKS = [
         ("before_create", Cache.PIPELINE.set.before),
         ("after_create", Cache.PIPELINE.set.after),
@@ -39,6 +54,12 @@ class Index:
             cls.__INDEXES__.setdefault(cls.cache_name, []).append(cls)
         else:
             cls.__INDEXES__.setdefault("__global__", []).append(cls)
+        for key in getattr(cls, "keys", ()):
+            cls.__KEY_BITS__.setdefault(key, 1 << len(cls.__KEY_BITS__))
+        cls.key_mask = cls.get_key_mask(getattr(cls, "keys", ()))
+        Index.find_indexes.cache_clear()
+        Index.find_best_index.cache_clear()
+        BloomFilter.get_keys.cache_clear()
 
         for hook, pipe_wrapper in cls.HOOKS:
             if hasattr(cls, hook):
@@ -97,10 +118,10 @@ class Index:
 
         (key,) = ctx.args
         cache = ctx.cls_or_self
-        value = cache._get(ctx.name, key)
+        shadow_copy = get_shadow_copy(cache._get(ctx.name, key))
         keys = []
         for index_key in cls.keys:
-            keys.append(str(value.__shadow_copy__[index_key]))
+            keys.append(str(shadow_copy[index_key]))
         ctx.local_data.setdefault("before_delete", {})[cls.__name__] = {
             "keys": ":".join(keys)
         }
@@ -119,10 +140,17 @@ class Index:
 
     @classmethod
     def before_update(cls, ctx: PipelineContext):
-        """Creates value copy for after_update usage."""
+        """Creates value copy for after_update usage.
+
+        Without shadow copies stored value is used as previous one.
+        """
 
         key, value = ctx.args
         ctx.local_data["original_value"] = value
+        cache = ctx.cls_or_self
+        shadow_copy = getattr(cache, "SHADOW_COPY", True)
+        if not shadow_copy and "stored_value" not in ctx.local_data:
+            ctx.local_data["stored_value"] = cache._get(ctx.name, key)
 
     @classmethod
     def after_update(cls, ctx: PipelineContext):
@@ -131,11 +159,14 @@ class Index:
         :param dict ctx: PipelineManager context.
         """
 
-        value = ctx.local_data["original_value"]
-        if cls.get_index(value.__shadow_copy__) != cls.get_index(ctx.result):
+        value = ctx.local_data.get("stored_value")
+        if value is None:
+            value = ctx.local_data["original_value"]
+        shadow_copy = get_shadow_copy(value)
+        if cls.get_index(shadow_copy) != cls.get_index(ctx.result):
             index_data = set(cls.get(ctx.name))
             try:
-                index_data.remove(cls.get_index(value.__shadow_copy__))
+                index_data.remove(cls.get_index(shadow_copy))
             except ValueError:
                 pass
             index_data.add(cls.get_index(ctx.result))
@@ -150,10 +181,58 @@ class Index:
         :return: list of matching indexes.
         """
 
-        return cls.__INDEXES__.get(cache_name, []) + cls.__INDEXES__.get(
-            "__global__", []
+        return list(cls.find_indexes(cache_name))
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def find_indexes(cls, cache_name: str) -> typing.Tuple[typing.Type["Index"], ...]:
+        """Finds indexes for specific cache name.
+
+        Result is cached until new index is created.
+
+        :param str cache_name: cache name.
+        :return: tuple of matching indexes.
+        """
+
+        return tuple(
+            cls.__INDEXES__.get(cache_name, []) + cls.__INDEXES__.get("__global__", [])
         )
 
+    @classmethod
+    def get_key_mask(cls, keys: typing.Iterable[str]) -> int:
+        """Composes bit mask of keys known to indexes.
+
+        :param keys: keys to compose mask of.
+        :return: int mask.
+        """
+
+        mask = 0
+        for key in keys:
+            mask |= cls.__KEY_BITS__.get(key, 0)
+        return mask
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def find_best_index(
+        cls, cache_name: str, query_keys: typing.FrozenSet[str]
+    ) -> typing.Type["Index"]:
+        """Finds index covering most of query keys.
+
+        Result is cached until new index is created.
+
+        :param str cache_name: cache name.
+        :param frozenset query_keys: search query keys.
+        :return: best matching index.
+        """
+
+        query_mask = cls.get_key_mask(query_keys)
+        best_index, best_match = None, -1
+        for index in cls.find_indexes(cache_name):
+            matched_keys = bin(index.key_mask & query_mask).count("1")
+            if matched_keys > best_match:
+                best_index, best_match = index, matched_keys
+        return best_index
+
     @classmethod
     def get_values(
         cls, index_data: typing.Union[typing.List, typing.Tuple, typing.Set]
@@ -166,6 +245,40 @@ class Index:
 
         return [dict(zip(cls.keys, value.split(":"))) for value in index_data]
 
+    @classmethod
+    def find_rows(cls, cache_name: str, query: typing.Mapping) -> typing.List[dict]:
+        """Finds index rows matching query.
+
+        Equality query over all index keys is answered by single lookup,
+        otherwise rows are split into per key columns and filtered column by column,
+        so dicts are only built for matching rows.
+
+        :param str cache_name: cache name.
+        :param dict query: search key:value for index keys.
+                           Values must be str or callable.
+        :return: list of dicts with index data.
+        """
+
+        index_data = set(cls.get(cache_name))
+        if len(query) == len(cls.keys) and not any(map(callable, query.values())):
+            row = cls.get_index(query)
+            return cls.get_values([row]) if row in index_data else []
+        if not index_data:
+            return []
+
+        rows = [row.split(":") for row in index_data]
+        columns = dict(zip(cls.keys, zip(*rows)))
+        positions = range(len(rows))
+        equal_pairs, callable_pairs = Cache._split_query(query)
+        for key, value in equal_pairs:
+            found = map(columns[key].__getitem__, positions)
+            selectors = map(operator.eq, found, itertools.repeat(value))
+            positions = list(itertools.compress(positions, selectors))
+        for key, predicate in callable_pairs:
+            found = map(columns[key].__getitem__, positions)
+            positions = list(itertools.compress(positions, map(predicate, found)))
+        return [dict(zip(cls.keys, rows[position])) for position in positions]
+
     @classmethod
     @Cache.PIPELINE.index_get
     def get(cls, cache_name):
@@ -173,7 +286,7 @@ class Index:
             Cache,
             cls.INDEX_CACHE_NAME,
             cls.get_name(cache_name),
-            default=IndexContainer(),
+            default=[],
         )
 
     @classmethod
@@ -188,5 +301,124 @@ class Index:
         cls.INDEX_CACHE_NAME = index_cache_name
 
 
+class BloomFilter:
+    """Bit array of indexed values stored next to index data.
+
+    Answers whether some key:value pair was never stored in cache,
+    so search can return early without reading index data.
+    """
+
+    SIZE: int = 8192
+    """Filter size in bytes."""
+
+    @classmethod
+    def get_name(cls, cache_name: str) -> str:
+        """Composes bloom filter name."""
+
+        return f"__bloom__:{cache_name}"
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def get_keys(cls, cache_name: str) -> typing.FrozenSet[str]:
+        """Finds keys tracked by indexes with enabled bloom filter.
+
+        Result is cached until new index is created.
+
+        :param str cache_name: cache name.
+        :return: set of tracked keys.
+        """
+
+        keys = set()
+        for index in Index.find_indexes(cache_name):
+            if index.bloom_filter:
+                keys.update(index.keys)
+        return frozenset(keys)
+
+    @classmethod
+    def get_positions(cls, key: str, value: typing.Any) -> typing.Tuple[int, int]:
+        """Calculates bit positions for key:value pair.
+
+        Uses stable hash as filter can be shared between processes.
+        """
+
+        digest = hashlib.blake2b(f"{key}:{value}".encode(), digest_size=8).digest()
+        bits = cls.SIZE * 8
+        return (
+            int.from_bytes(digest[:4], "little") % bits,
+            int.from_bytes(digest[4:], "little") % bits,
+        )
+
+    @classmethod
+    def add(cls, cache_name: str, value: typing.Mapping):
+        """Adds tracked key:value pairs of value to bloom filter.
+
+        :param str cache_name: cache name.
+        :param dict value: cached value.
+        """
+
+        keys = cls.get_keys(cache_name)
+        if not keys:
+            return
+        name = cls.get_name(cache_name)
+        bloom = Cache.GET_METHOD(Cache, Index.INDEX_CACHE_NAME, name, default=None)
+        if bloom is None:
+            bloom = bytearray(cls.SIZE)
+        else:
+            bloom = bytearray(bloom)
+        for key in keys:
+            for position in cls.get_positions(key, value[key]):
+                bloom[position >> 3] |= 1 << (position & 7)
+        Cache.SET_METHOD(Cache, Index.INDEX_CACHE_NAME, name, bloom)
+
+    @classmethod
+    def might_contain(cls, cache_name: str, search_query: typing.Mapping) -> bool:
+        """Checks if values matching equality terms of query can exist.
+
+        Terms are compared as str, so pass only index subquery here.
+
+        :param str cache_name: cache name.
+        :param dict search_query: search key:value for index keys.
+        :return: False if no stored value can match query.
+        """
+
+        keys = cls.get_keys(cache_name)
+        terms = [
+            (key, value)
+            for key, value in search_query.items()
+            if key in keys and not callable(value)
+        ]
+        if not terms:
+            return True
+        bloom = Cache.GET_METHOD(
+            Cache, Index.INDEX_CACHE_NAME, cls.get_name(cache_name), default=None
+        )
+        if bloom is None:
+            return True
+        for key, value in terms:
+            for position in cls.get_positions(key, value):
+                if not bloom[position >> 3] & (1 << (position & 7)):
+                    return False
+        return True
+
+
 class PkIndex(Index):
     keys = ["_id"]
+
+
+@Cache.PIPELINE.set.after()
+def add_to_bloom_filter(ctx: PipelineContext):
+    """Adds stored value to cache bloom filter."""
+
+    key, value = ctx.args
+    BloomFilter.add(ctx.name, value)
+
+
+@Cache.PIPELINE.update.after()
+def add_updated_to_bloom_filter(ctx: PipelineContext):
+    """Adds updated value to cache bloom filter.
+
+    Indexes store value returned by update method, so it is used if any.
+    """
+
+    key, value = ctx.args
+    BloomFilter.add(ctx.name, value if ctx.result is None else ctx.result)
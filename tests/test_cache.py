@@ -1,11 +1,14 @@
 import collections
+import enum
+import gc
+import weakref
 from unittest.mock import MagicMock
 
 import bson
 import pytest
 
-from ihashmap.cache import Cache
-from ihashmap.index import Index, IndexContainer
+from ihashmap.cache import Cache, Pipeline
+from ihashmap.index import BloomFilter, Index, IndexContainer
 
 
 @pytest.fixture
@@ -70,6 +73,9 @@ def test_Cache_simple(fake_cache, fake_get, fake_set, fake_update, fake_delete):
     assert cache.search("test", {"model": 1}) == [
         entity,
     ]
+    assert cache.search("test", {"model": 1}, project_only=True) == [
+        {"_id": "1234", "model": "1"},
+    ]
 
     class Cache2(Cache):
         pass
@@ -115,3 +121,324 @@ def test_IndexContainer_append():
 
     container.append(id1)
     assert container == [id1, id2]
+
+
+def test_Pipeline_invalidate():
+    class Cache3(Cache):
+        pass
+
+    first = MagicMock()
+    second = MagicMock()
+
+    Cache3.PIPELINE.delete.before(priority=2)(first)
+    assert first in [action.f for action in Cache3.PIPELINE.delete.pipe_before]
+
+    Cache.PIPELINE.delete.before(priority=3, cache_name="pipeline_test")(second)
+    pipe = [action.f for action in Cache3.PIPELINE.delete.pipe_before]
+    assert pipe.index(first) < pipe.index(second)
+
+    gc.collect()
+    children = len(Cache.PIPELINE.delete._children)
+    del Cache3
+    gc.collect()
+    assert len(Cache.PIPELINE.delete._children) == children - 1
+
+
+def test_Cache_get_many(fake_cache, fake_get, fake_set, monkeypatch):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    get_many = MagicMock(
+        side_effect=lambda name, keys: [fake_cache[name].get(key) for key in keys]
+    )
+    monkeypatch.setattr(Cache, "GET_MANY_METHOD", None)
+    Cache.register_get_many_method(lambda self, name, keys: get_many(name, keys))
+
+    cache = Cache()
+    entity = collections.UserDict({"_id": "1", "model": 1})
+    entity2 = collections.UserDict({"_id": "2", "model": 2})
+    cache.set("batch_test", "1", entity)
+    cache.set("batch_test", "2", entity2)
+
+    assert sorted(cache.all("batch_test"), key=lambda value: value["_id"]) == [
+        entity,
+        entity2,
+    ]
+    assert get_many.call_count == 1
+    assert entity.__shadow_copy__ is entity
+
+    assert len(list(cache.iter_all("batch_test", batch_size=1))) == 2
+    assert get_many.call_count == 3
+
+    assert cache.search("batch_test", {"_id": "2"}) == [entity2]
+    assert get_many.call_count == 4
+
+    assert cache.get_many("batch_test", ["2", "3", "1"]) == [entity2, None, entity]
+    assert get_many.call_count == 5
+
+    class BatchCache(Cache):
+        pass
+
+    mocked_func = MagicMock()
+    BatchCache.PIPELINE.get.after()(mocked_func)
+    assert BatchCache().get_many("batch_test", ["2", "1"]) == [entity2, entity]
+    assert mocked_func.call_count == 2
+    assert [call[0][0].args for call in mocked_func.call_args_list] == [
+        ("2",),
+        ("1",),
+    ]
+
+
+def test_BloomFilter(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    class IndexByColor(Index):
+        keys = ["_id", "color"]
+        cache_name = "bloom_test"
+        bloom_filter = True
+
+    cache = Cache()
+    entity = collections.UserDict({"_id": "1", "color": "red"})
+    cache.set("bloom_test", "1", entity)
+
+    assert BloomFilter.get_name("bloom_test") in fake_cache[Index.INDEX_CACHE_NAME]
+    assert BloomFilter.might_contain("bloom_test", {"color": "red"})
+    assert not BloomFilter.might_contain("bloom_test", {"color": "blue"})
+    assert BloomFilter.might_contain("bloom_test", {"color": lambda color: True})
+
+    assert cache.search("bloom_test", {"color": "red"}) == [entity]
+    assert cache.search("bloom_test", {"color": "blue"}) == []
+
+    entity2 = collections.UserDict({"_id": "2", "color": "green"})
+    cache.set("bloom_test", "2", entity2)
+    assert BloomFilter.might_contain("bloom_test", {"color": "red"})
+    assert BloomFilter.might_contain("bloom_test", {"color": "green"})
+    assert cache.search("bloom_test", {"color": "green"}) == [entity2]
+
+    def _update(self, name, key, value):
+        value = collections.UserDict(value, color=value["color"].lower())
+        fake_cache[name][key] = value
+        return value
+
+    Cache.register_set_method(
+        lambda self, name, key, value: fake_set(self, name, key, value) and None
+    )
+    Cache.register_update_method(_update)
+    entity4 = collections.UserDict({"_id": "4", "color": "yellow"})
+    cache.set("bloom_test", "4", entity4)
+    entity4["color"] = "BLUE"
+    updated = cache.update("bloom_test", "4", entity4)
+    assert "4:blue" in fake_cache[Index.INDEX_CACHE_NAME]["bloom_test:_id_color"]
+    assert cache.search("bloom_test", {"color": "blue"}) == [updated]
+    Cache.register_set_method(fake_set)
+
+    class IndexByLevel(Index):
+        keys = ["_id", "level"]
+        cache_name = "bloom_rest_test"
+        bloom_filter = True
+
+    class IndexByShape(Index):
+        keys = ["_id", "shape", "size"]
+        cache_name = "bloom_rest_test"
+
+    entity3 = collections.UserDict({"_id": "3", "level": 1, "shape": "sq", "size": 2})
+    cache.set("bloom_rest_test", "3", entity3)
+    query = {"shape": "sq", "size": 2, "level": 1.0}
+    assert cache.search("bloom_rest_test", query) == [entity3]
+
+
+def test_Cache_no_shadow_copy(fake_cache, fake_get, fake_set, fake_delete):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+    Cache.register_update_method(fake_set)
+    Cache.register_delete_method(fake_delete)
+
+    class PlainCache(Cache):
+        SHADOW_COPY = False
+
+    class IndexByPlainModel(Index):
+        keys = ["_id", "model"]
+        cache_name = "plain_test"
+
+    cache = PlainCache()
+    entity = collections.UserDict({"_id": "1", "model": 1})
+    cache.set("plain_test", "1", entity)
+
+    assert cache.get("plain_test", "1") is entity
+    assert not hasattr(entity, "__shadow_copy__")
+
+    updated = collections.UserDict({"_id": "1", "model": 2})
+    cache.update("plain_test", "1", updated)
+    assert not hasattr(updated, "__shadow_copy__")
+    assert fake_cache[Index.INDEX_CACHE_NAME]["plain_test:_id"] == ["1"]
+    assert fake_cache[Index.INDEX_CACHE_NAME]["plain_test:_id_model"] == ["1:2"]
+    assert cache.search("plain_test", {"model": 2}) == [updated]
+
+    cache.delete("plain_test", "1")
+    assert fake_cache[Index.INDEX_CACHE_NAME]["plain_test:_id"] == []
+    assert fake_cache[Index.INDEX_CACHE_NAME]["plain_test:_id_model"] == []
+
+
+def test_Cache_register_after_get():
+    cache = Cache()
+
+    Cache.register_get_method(lambda self, name, key, default=None: None)
+    assert cache.get("register_test", "1") is None
+
+    entity = collections.UserDict({"_id": "1"})
+    Cache.register_get_method(lambda self, name, key, default=None: entity)
+    assert cache.get("register_test", "1") is entity
+    assert cache._get("register_test", "1") is entity
+
+
+def test_Cache_enum_name(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    class Names(str, enum.Enum):
+        ENUM_TEST = "enum_test"
+
+    mocked_func = MagicMock()
+    Cache.PIPELINE.get.after(cache_name=Names.ENUM_TEST)(mocked_func)
+
+    cache = Cache()
+    entity = collections.UserDict({"_id": "1"})
+    cache.set(Names.ENUM_TEST, "1", entity)
+
+    assert cache.get(Names.ENUM_TEST, "1") is entity
+    assert mocked_func.call_count == 1
+    cache.get("enum_test", "1")
+    assert mocked_func.call_count == 2
+
+
+def test_Cache_search_rest_query(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    class IndexByKind(Index):
+        keys = ["_id", "kind"]
+        cache_name = "rest_test"
+
+    cache = Cache()
+    entities = [
+        collections.UserDict({"_id": "1", "kind": 1, "color": "red", "size": 3}),
+        collections.UserDict({"_id": "2", "kind": 1, "color": "blue", "size": 3}),
+        collections.UserDict({"_id": "3", "kind": 1, "color": "red", "size": 1}),
+        collections.UserDict({"_id": "4", "kind": 2, "color": "red", "size": 3}),
+        collections.UserDict({"_id": "5", "kind": 1, "color": "red", "size": 2}),
+    ]
+    for entity in entities:
+        cache.set("rest_test", entity["_id"], entity)
+
+    query = {"kind": 1, "color": "red", "size": lambda size: size > 1}
+    found = cache.search("rest_test", query)
+    assert sorted(found, key=lambda value: value["_id"]) == [entities[0], entities[4]]
+
+    rest_query = {"color": "red", "size": lambda size: size > 1}
+    assert Cache._filter_batch(entities[::-1], rest_query) == [
+        entities[4],
+        entities[3],
+        entities[0],
+    ]
+
+
+def test_Cache_set_shadow_copy(fake_cache, fake_get):
+    def _set(self, name, key, value):
+        fake_cache.setdefault(name, {})[key] = value
+
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(_set)
+
+    cache = Cache()
+    entity = collections.UserDict({"_id": "1", "model": 1})
+    assert cache.set("set_copy_test", "1", entity) is None
+
+    shadow_copy = entity.__shadow_copy__
+    assert shadow_copy is not entity
+    assert shadow_copy.data is not entity.data
+    assert shadow_copy.data == {"_id": "1", "model": 1}
+    assert not hasattr(shadow_copy, "__shadow_copy__")
+
+    entity["model"] = 2
+    assert shadow_copy["model"] == 1
+
+
+def test_Pipeline_other_caller(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    entity = collections.UserDict({"_id": "1", "model": 1})
+    updated = collections.UserDict({"_id": "1", "model": 2})
+    Cache().set("other_test", "1", entity)
+
+    @Cache.PIPELINE.get
+    def get(caller, name, key):
+        return entity
+
+    @Cache.PIPELINE.update
+    def update(caller, name, key, value):
+        return value
+
+    assert get(object(), "other_test", "1") is entity
+    assert update(object(), "other_test", "1", updated) is updated
+    assert updated.__shadow_copy__ is updated
+
+
+def test_Cache_subclass_collected(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    def use_subclass():
+        class TemporaryCache(Cache):
+            pass
+
+        TemporaryCache().set("collect_test", "1", collections.UserDict({"_id": "1"}))
+        TemporaryCache().get("collect_test", "1")
+        return weakref.ref(TemporaryCache)
+
+    subclass = use_subclass()
+    gc.collect()
+    assert subclass() is None
+
+
+def test_Pipeline_nested_call(fake_cache, fake_get, fake_set):
+    Cache.register_get_method(fake_get)
+    Cache.register_set_method(fake_set)
+
+    class NestedCache(Cache):
+        pass
+
+    seen = []
+
+    @NestedCache.PIPELINE.get.before()
+    def get_other(ctx):
+        ctx.local_data["outer"] = ctx.args
+        if ctx.args == ("1",):
+            ctx.cls_or_self.get(ctx.name, "2")
+
+    @NestedCache.PIPELINE.get.after()
+    def check_context(ctx):
+        seen.append((ctx.args, dict(ctx.local_data)))
+
+    cache = NestedCache()
+    cache.set("nested_test", "1", collections.UserDict({"_id": "1"}))
+    cache.set("nested_test", "2", collections.UserDict({"_id": "2"}))
+
+    assert cache.get("nested_test", "1")["_id"] == "1"
+    assert seen == [(("2",), {"outer": ("2",)}), (("1",), {"outer": ("1",)})]
+
+
+def test_Pipeline_many_names(monkeypatch):
+    class NamesCache(Cache):
+        pass
+
+    monkeypatch.setattr(Pipeline, "APPLICABLE_CACHE_SIZE", 8)
+    cache = NamesCache()
+    Cache.register_get_method(lambda self, name, key, default=None: None)
+    for number in range(20):
+        cache.get(f"names_test_{number}", "1")
+
+    pipe = NamesCache.PIPELINE.get
+    assert len(pipe._applicable_cache) <= 8
+    assert pipe.runner_for("names_test_0") is pipe.runner_for("names_test_19")